@@ -1,8 +1,17 @@
 import json
+import os
+import queue
+import sqlite3
+import threading
+import time
 import click
-import mutagen
+import requests
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from mutagen.mp4 import MP4
 from pathlib import Path
+from requests.adapters import HTTPAdapter, Retry
 from tinytag import TinyTag
 from tqdm import tqdm
 from yt_dlp import YoutubeDL
@@ -14,43 +23,194 @@ LYR_TAG = "©lyr"
 DAY_TAG = "©day"
 NO_SYNCED_LYRICS = "[00:00.00] No synced lyrics found."
 NO_UNSYNCED_LYRICS = "No unsynced lyrics found."
+YTM_WATCH_URL = "https://music.youtube.com/watch?v={}"
+# Free space kept in the m4a header so that lyrics can be saved in place
+LYRICS_PADDING = 16 * 1024
+# Songs whose lyrics are done, by id and the m4a mtime when they were checked.
+# Changed files are looked at again, deleting it re-checks the whole library.
+STATE_FILE = ".ytmlm.sqlite"
+LRCLIB_URL = "https://lrclib.net/api"
+LRCLIB_RETRIES = 5
+LRCLIB_MAX_BACKOFF = 30
+# Requests per second across all lyrics workers
+LRCLIB_RATE = 10
+
+
+class RateLimiter:
+    """Spread calls from all threads to at most rate per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        """Hold back every thread, for when the server asks to slow down"""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+# Shared so that all lrclib lookups reuse the same keep-alive connections
+lrclib_session = requests.Session()
+lrclib_session.headers["User-Agent"] = "ytmlm (https://github.com/adyanth/ytmlm)"
+lrclib_limiter = RateLimiter(LRCLIB_RATE)
 
 
 def get_id_from_filename(file: str):
-    return file.split("[")[-1].split("]")[0]
+    return file.rpartition("[")[2].partition("]")[0]
 
 
 def get_id_from_filepath(file: Path):
     return get_id_from_filename(file.name)
 
 
-def get_synced_lyrics(file_path):
-    import requests
+def walk_m4a_files(root: str):
+    # Plain os.scandir walk, only the file name is needed to get the id so no
+    # Path objects are built for the whole library
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            # Unreadable directories are skipped, like Path.glob does
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".m4a"):
+                    yield get_id_from_filename(entry.name), entry
+
+
+def lyrics_padding(info) -> int:
+    # Keep any slack that is left and only reserve more once the tags outgrow it
+    return info.padding if info.padding >= 0 else LYRICS_PADDING
+
 
-    tags = TinyTag.get(file_path)
+def ensure_padding(file_path):
+    m4a = MP4(file_path)
+    m4a.save(padding=lambda info: max(info.padding, LYRICS_PADDING))
 
-    url = "https://lrclib.net/api/get"
-    params = {
+
+def needs_lyrics(tags: TinyTag) -> bool:
+    # Need both synced and unsynced lyrics to not try again
+    return len(tags.other.get("lyrics", [])) != 2
+
+
+def open_state(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS lyrics_done (id TEXT PRIMARY KEY, mtime REAL)"
+    )
+    return conn
+
+
+def get_done_row(videoId: str, file: Path) -> tuple:
+    return videoId, file.stat().st_mtime
+
+
+def get_track_meta(tags: TinyTag) -> dict:
+    return {
         "artist_name": tags.artist,
         "track_name": tags.title,
         "album_name": tags.album,
         "duration": int(tags.duration),
     }
 
-    response = requests.get(url, params=params)
+
+def get_retry_after(response) -> float | None:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        # Missing, or given as an HTTP date
+        return None
+
+
+def lrclib_get(endpoint: str, params: dict):
+    # Back off while lrclib is rate limiting or unavailable, for as long as it
+    # asks to or exponentially otherwise
+    for attempt in range(LRCLIB_RETRIES):
+        lrclib_limiter.wait()
+        response = lrclib_session.get(f"{LRCLIB_URL}/{endpoint}", params=params)
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        # Nothing to wait for once the last attempt has failed
+        if attempt < LRCLIB_RETRIES - 1:
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = 2**attempt
+            lrclib_limiter.pause(min(delay, LRCLIB_MAX_BACKOFF))
+    return response
+
+
+def get_synced_lyrics(meta: dict) -> str | None:
+    response = lrclib_get("get", meta)
     match response.status_code:
         case 200:
-            if lyrics := response.json()["syncedLyrics"]:
-                return lyrics
-            else:
-                return NO_SYNCED_LYRICS
+            return response.json()["syncedLyrics"] or None
         case 400 | 404:
-            return NO_SYNCED_LYRICS
+            return None
         case _:
             response.raise_for_status()
             raise Exception()
 
 
+def search_album_lyrics(artist: str, album: str) -> list:
+    response = lrclib_get("search", {"q": f"{artist} {album}"})
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_synced_lyrics_batch(tracks_meta: dict, executor) -> dict:
+    """Look up synced lyrics with one lrclib search per artist and album
+
+    Only albums with more than one track are searched, everything that is not
+    found here should still go through get_synced_lyrics.
+    """
+
+    def key(*values):
+        return tuple((value or "").casefold().strip() for value in values)
+
+    albums = {}
+    for videoId, meta in tracks_meta.items():
+        if meta is None:
+            continue
+        albums.setdefault(
+            key(meta["artist_name"], meta["album_name"]), []
+        ).append(videoId)
+    albums = {album: ids for album, ids in albums.items() if len(ids) > 1}
+
+    def search(album):
+        try:
+            return search_album_lyrics(*album)
+        except Exception:
+            # Missing out here only means falling back to get_synced_lyrics
+            return []
+
+    found = {}
+    for album, rows in zip(albums, executor.map(search, albums)):
+        for videoId in albums[album]:
+            meta = tracks_meta[videoId]
+            for row in rows:
+                if (
+                    row.get("syncedLyrics")
+                    and key(row["artistName"], row["trackName"], row["albumName"])
+                    == key(meta["artist_name"], meta["track_name"], meta["album_name"])
+                    and row.get("duration") is not None
+                    and abs(row["duration"] - meta["duration"]) <= 2
+                ):
+                    found[videoId] = row["syncedLyrics"]
+                    break
+    return found
+
+
 @click.command()
 @click.option(
     "--music-dir",
@@ -108,6 +268,20 @@ def get_synced_lyrics(file_path):
     type=str,
     help="Comma separated Youtube IDs to skip download",
 )
+@click.option(
+    "--concurrency",
+    envvar="YTMLM_CONCURRENCY",
+    default=4,
+    type=click.IntRange(min=1),
+    help="Number of songs to download in parallel (4)",
+)
+@click.option(
+    "--lyrics-concurrency",
+    envvar="YTMLM_LYRICS_CONCURRENCY",
+    default=32,
+    type=click.IntRange(min=1),
+    help="Number of songs to fetch lyrics for in parallel (32)",
+)
 def ytmlm(
     music_dir: Path,
     limit: int,
@@ -117,6 +291,8 @@ def ytmlm(
     oauth_client_secret_content: str,
     cookie_txt: Path,
     skip_ids: str,
+    concurrency: int,
+    lyrics_concurrency: int,
 ):
     """Download liked music from YTM"""
 
@@ -130,115 +306,152 @@ def ytmlm(
     else:
         if not oauth_file.exists():
             setup_oauth(filepath=str(oauth_file))
-        oauth_content = json.loads(oauth_file.read_text())
+        oauth_dict = json.loads(oauth_file.read_text())
 
     oauth_client_dict = None
     if oauth_client_secret_content is not None:
-        oauth_client_dict = oauth_client_secret_content
+        oauth_client_dict = json.loads(oauth_client_secret_content)
     else:
         if not oauth_client_secret_file.exists():
             raise Exception("Client secret file or content needed")
         oauth_client_dict = json.loads(oauth_client_secret_file.read_text())
 
     ytm = YTMusic(
-        oauth_content,
+        oauth_dict,
         oauth_credentials=OAuthCredentials(
             client_id=oauth_client_dict["installed"]["client_id"],
             client_secret=oauth_client_dict["installed"]["client_secret"]
         )
     )
 
+    # ytmusicapi already keeps one requests session (with its own timeout), size
+    # its pool for the lyrics workers and retry transient errors. The YTM API
+    # only reads data here, so retrying its POST requests is safe.
+    ytm._session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=lyrics_concurrency,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 502, 503],
+                allowed_methods=None,
+            ),
+        ),
+    )
+
     print("Getting liked music")
     tracks = ytm.get_liked_songs(limit)["tracks"]
 
     # To debug
     # tracks = [{"videoId": "videoId", "title": "Test Song"}]
 
-    existing_ids = set(map(get_id_from_filepath, music_dir.glob("**/*.m4a")))
+    # Walk the library once, songs downloaded below are added as they finish
+    m4a_files = dict(walk_m4a_files(str(music_dir)))
+    existing_ids = set(m4a_files)
     if skip_ids:
-        ids = list(map(lambda x: x.strip(), skip_ids.split(",")))
+        ids = [x.strip() for x in skip_ids.split(",")]
         if len(ids) > 0 and len(ids[0]) > 0:
             existing_ids.update(ids)
 
-    to_download = list(filter(lambda x: x["videoId"] not in existing_ids, tracks))
+    to_download = [x for x in tracks if x["videoId"] not in existing_ids]
 
     print(f"Got {len(tracks)} tracks, {len(to_download)} new to download")
-    print("")
 
-    ytdl = YoutubeDL(
-        {
-            "format": "ba[ext=m4a]",
-            "cookiefile": (
-                str(cookie_txt.absolute())
-                if cookie_txt and cookie_txt.is_file()
-                else None
-            ),
-            "writethumbnail": True,
-            "outtmpl": {
-                "default": f"{music_dir.absolute()}/%(artist)s/%(album)s/%(title)s - %(artist)s [%(id)s].%(ext)s",
-                "pl_thumbnail": "",
+    downloaded_files = {}
+
+    def on_downloaded(filepath: str):
+        file = Path(filepath)
+        downloaded_files[get_id_from_filepath(file)] = file
+        # Reserve room for the lyrics while the song is still fresh in the
+        # page cache, so saving them later does not rewrite the whole file
+        ensure_padding(filepath)
+
+    ytdl_opts = {
+        "format": "ba[ext=m4a]",
+        # Fetch fragmented formats a few pieces at a time
+        "concurrent_fragment_downloads": 4,
+        "cookiefile": (
+            str(cookie_txt.absolute())
+            if cookie_txt and cookie_txt.is_file()
+            else None
+        ),
+        "writethumbnail": True,
+        "outtmpl": {
+            "default": f"{music_dir.absolute()}/%(artist)s/%(album)s/%(title)s - %(artist)s [%(id)s].%(ext)s",
+            "pl_thumbnail": "",
+        },
+        "postprocessors": [
+            {
+                "key": "FFmpegMetadata",
+                "add_chapters": True,
+                "add_metadata": True,
+                "add_infojson": "if_exists",
             },
-            "postprocessors": [
-                {
-                    "key": "FFmpegMetadata",
-                    "add_chapters": True,
-                    "add_metadata": True,
-                    "add_infojson": "if_exists",
-                },
-                {"key": "EmbedThumbnail", "already_have_thumbnail": False},
-            ],
-        }
-    )
-
-    print("Downloading songs")
-    ytdlp_errors = []
-    for track in (t := tqdm(to_download)):
-        try:
-            t.set_description(
-                f"Downloading song {track.get('title', track.get('videoId', 'Unknwon'))}"
-            )
-            url = f"https://music.youtube.com/watch?v={track['videoId']}"
-            ytdl.download(url)
-        except Exception as e:
-            ytdlp_errors.append((track, e))
-
-    print("Downloading lyrics: ", end="")
-    newIds = set(map(lambda x: x["videoId"], tracks))
-    videoId_file_dict = dict(
-        filter(
-            lambda videoId_file: videoId_file[0] in newIds,
-            map(
-                lambda file: (get_id_from_filepath(file), file),
-                music_dir.glob("**/*.m4a"),
-            ),
+            {"key": "EmbedThumbnail", "already_have_thumbnail": False},
+        ],
+        "post_hooks": [on_downloaded],
+    }
+    # YoutubeDL keeps state for the download in progress, so every worker
+    # thread gets its own instance instead of sharing one. The instance is
+    # reused for all songs of that thread, so the extractors, postprocessors
+    # and output template are only set up once per worker. Passing several
+    # URLs to one download() call would not save more, yt-dlp loops over
+    # them one by one and stops at the first failure.
+    ytdl_local = threading.local()
+
+    def download(videoId: str):
+        if not hasattr(ytdl_local, "ytdl"):
+            ytdl_local.ytdl = YoutubeDL(ytdl_opts)
+        return ytdl_local.ytdl.download([YTM_WATCH_URL.format(videoId)])
+
+    # Songs that already got both lyrics, to skip opening them again
+    state = open_state(music_dir / STATE_FILE)
+    lyrics_done = dict(state.execute("SELECT id, mtime FROM lyrics_done"))
+    newIds = {x["videoId"] for x in tracks}
+    videoId_file_dict = {
+        videoId: Path(entry.path)
+        for videoId, entry in m4a_files.items()
+        if videoId in newIds
+        # Files changed since they were done, e.g. lyrics removed, are re-read
+        and (
+            videoId not in lyrics_done
+            or lyrics_done[videoId] != entry.stat().st_mtime
         )
-    )
-    m4a_dict = dict(
-        filter(
-            lambda videoId_m4a: LYR_TAG not in videoId_m4a[1]
-            or videoId_m4a[1][LYR_TAG] is None
-            # Need both synced and unsynced lyrics to not try again
-            or len(videoId_m4a[1][LYR_TAG]) != 2,
-            map(
-                lambda videoId_file: (
-                    videoId_file[0],
-                    mutagen.File(videoId_file[1].absolute()),
-                ),
-                videoId_file_dict.items(),
-            ),
+    }
+    # Parsing the tags is mostly disk reads, so open the files in parallel.
+    # Only the small TinyTag results are kept around, the full m4a with its
+    # cover art is loaded with mutagen right before saving the lyrics.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        scanned_tags = dict(
+            zip(
+                videoId_file_dict,
+                executor.map(TinyTag.get, videoId_file_dict.values()),
+            )
         )
-    )
-    print(f"{len(m4a_dict)} new to download")
-    lyrics_errors = []
-    for videoId, m4a in (t := tqdm(m4a_dict.items())):
+    tags_dict = {
+        videoId: tags
+        for videoId, tags in scanned_tags.items()
+        if needs_lyrics(tags)
+    }
+    done_rows = [
+        get_done_row(videoId, videoId_file_dict[videoId])
+        for videoId, tags in scanned_tags.items()
+        if videoId not in tags_dict
+    ]
+    print(f"{len(tags_dict)} existing songs without lyrics")
+    print("")
+
+    def download_lyrics(videoId: str) -> list:
         file: Path = videoId_file_dict[videoId]
+        errors = []
+        m4a = MP4(file.absolute())
         # Clean up
         if len(m4a[DAY_TAG]) == 1:
             if len(m4a[DAY_TAG][0]) != 4:
                 m4a[DAY_TAG][0] = m4a[DAY_TAG][0][:4]
 
-        t.set_description(f"Downloading lyrics for {file.name}")
-
         lyrics = []
         # Unsynced lyrics from YT
         try:
@@ -248,23 +461,158 @@ def ytmlm(
                 unsynced = NO_UNSYNCED_LYRICS
             lyrics.append(unsynced)
         except Exception as e:
-            lyrics_errors.append((file.name, e))
+            errors.append((file.name, e))
 
         # Synced lyrics from lrclib
-        synced = None
         try:
-            synced = get_synced_lyrics(file)
-            lyrics.append(synced)
-            # Also dump to lrc file
-            if synced != NO_SYNCED_LYRICS:
-                with open(file.with_suffix(".lrc"), "w") as f:
-                    f.write(synced)
+            synced = synced_found.get(videoId)
+            if synced is None:
+                # Songs downloaded in this run were not part of the tag scan
+                meta = tracks_meta.get(videoId) or get_track_meta(
+                    tags_dict.get(videoId) or TinyTag.get(file)
+                )
+                synced = get_synced_lyrics(meta)
+            if synced is not None:
+                lyrics.append(synced)
+                # Also dump to lrc file
+                lrc_queue.put((file.with_suffix(".lrc"), synced))
+            else:
+                lyrics.append(NO_SYNCED_LYRICS)
         except Exception as e:
-            lyrics_errors.append((file.name, e))
+            errors.append((file.name, e))
 
         m4a[LYR_TAG] = lyrics
         # Save the lyrics
-        m4a.save()
+        m4a.save(padding=lyrics_padding)
+        return errors
+
+    def read_track_meta(tags: TinyTag):
+        try:
+            return get_track_meta(tags)
+        except Exception:
+            # Retried and reported when fetching lyrics for the file
+            return None
+
+    # Keep a connection around for every lyrics worker
+    lrclib_session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=1, pool_maxsize=lyrics_concurrency),
+    )
+
+    ytdlp_errors = []
+    lyrics_errors = []
+    # A single writer thread dumps the lrc files so the workers never wait on disk
+    lrc_queue = queue.Queue()
+
+    def write_lrc_files():
+        while (item := lrc_queue.get()) is not None:
+            path, synced = item
+            try:
+                with open(path, "w") as f:
+                    f.write(synced)
+            except Exception as e:
+                lyrics_errors.append((path.name, e))
+
+    lrc_writer = threading.Thread(target=write_lrc_files, daemon=True)
+    lrc_writer.start()
+
+    print("Downloading songs and lyrics")
+    # Lyrics lookups are small round trips to YTM and lrclib, so they can be
+    # fanned out much wider than the song downloads. Both run at the same
+    # time, every song is handed to the lyrics workers once it is downloaded.
+    # The album searches for songs already in the library run in the
+    # background too, their lyrics jobs are submitted once it is done.
+    # Songs downloaded in this run always look up their lyrics one by one.
+    with (
+        ThreadPoolExecutor(max_workers=concurrency) as download_executor,
+        ThreadPoolExecutor(max_workers=lyrics_concurrency) as lyrics_executor,
+        ThreadPoolExecutor(max_workers=1) as batch_executor,
+    ):
+        download_futures = {
+            download_executor.submit(download, track["videoId"]): track
+            for track in to_download
+        }
+        tracks_meta = {
+            videoId: read_track_meta(tags) for videoId, tags in tags_dict.items()
+        }
+        synced_found = {}
+        batch_future = batch_executor.submit(
+            fetch_synced_lyrics_batch, tracks_meta, lyrics_executor
+        )
+        lyrics_futures = {}
+
+        # Only redraw a few times a second, lyrics can finish much faster
+        download_bar = tqdm(
+            total=len(download_futures),
+            desc="Songs",
+            position=0,
+            mininterval=0.2,
+            miniters=1,
+        )
+        lyrics_bar = tqdm(
+            total=len(tags_dict),
+            desc="Lyrics",
+            position=1,
+            mininterval=0.2,
+            miniters=1,
+        )
+        pending = download_futures.keys() | {batch_future}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future is batch_future:
+                    try:
+                        synced_found.update(future.result())
+                    except Exception:
+                        # Every song falls back to get_synced_lyrics
+                        pass
+                    for videoId in tags_dict:
+                        lyrics_future = lyrics_executor.submit(
+                            download_lyrics, videoId
+                        )
+                        lyrics_futures[lyrics_future] = videoId
+                        pending.add(lyrics_future)
+                elif future in download_futures:
+                    track = download_futures[future]
+                    download_bar.set_postfix_str(
+                        track.get("title", track.get("videoId", "Unknown")),
+                        refresh=False,
+                    )
+                    download_bar.update()
+                    if e := future.exception():
+                        ytdlp_errors.append((track, e))
+                    elif file := downloaded_files.get(track["videoId"]):
+                        videoId_file_dict[track["videoId"]] = file
+                        lyrics_future = lyrics_executor.submit(
+                            download_lyrics, track["videoId"]
+                        )
+                        lyrics_futures[lyrics_future] = track["videoId"]
+                        pending.add(lyrics_future)
+                        lyrics_bar.total += 1
+                else:
+                    videoId = lyrics_futures[future]
+                    file: Path = videoId_file_dict[videoId]
+                    lyrics_bar.set_postfix_str(file.name, refresh=False)
+                    lyrics_bar.update()
+                    try:
+                        errors = future.result()
+                    except Exception as e:
+                        errors = [(file.name, e)]
+                    if errors:
+                        lyrics_errors.extend(errors)
+                    else:
+                        done_rows.append(get_done_row(videoId, file))
+        download_bar.close()
+        lyrics_bar.close()
+    lrc_queue.put(None)
+    lrc_writer.join()
+
+    # One transaction for the whole run
+    with state:
+        state.executemany(
+            "INSERT OR REPLACE INTO lyrics_done VALUES (?, ?)", done_rows
+        )
+    state.close()
 
     print("\nDownload complete.\n\nyt-dlp failures:\n")
     for track, e in ytdlp_errors: